@@ -1,11 +1,126 @@
-from typing import Dict, Literal, List, Optional
+from functools import lru_cache
+from math import floor, ceil
+from typing import Dict, Literal, List, Optional, Tuple
 from time import time
 import logging
 
-import pulp
+import numpy as np
 import pandas as pd
 import altair as alt
-from numpy import floor, ceil
+from scipy.optimize import Bounds, LinearConstraint, milp
+from scipy.sparse import csr_matrix
+
+
+@lru_cache(maxsize=32)
+def _solve(
+    instruments: Tuple[str, ...],
+    idealcounts: Tuple[int, ...],
+    students: Tuple[str, ...],
+    preference_lists: Tuple[Tuple[str, ...], ...],
+    preference: str,
+) -> pd.DataFrame:
+    """
+    Solves the band assignment mixed integer linear programming problem with
+    SciPy's HiGHS backed milp.
+
+    Results are cached on the problem inputs so identical problems are only
+    solved once; copy the returned DataFrame before mutating it.
+    """
+    instrument_index = {i: index for index, i in enumerate(instruments)}
+    band = np.zeros((len(students), len(instruments)), dtype=np.int8)
+
+    # Without instrumentation limits the composition term is constant
+    # (every student plays exactly one instrument), so the optimum is
+    # simply each student's first choice and the solver can be skipped.
+    if preference == "students" and all(preference_lists):
+        for s_index, preferences in enumerate(preference_lists):
+            band[s_index, instrument_index[preferences[0]]] = 1
+        return pd.DataFrame(band, index=students, columns=instruments)
+
+    weights = {"students": (1, 5), "balanced": (3, 3), "instrumentation": (5, 1)}
+    composition_weight, preference_weight = weights[preference]
+
+    # Setup Vector of Parameters, one per student's preferred instrument,
+    # in student order and then preference order.
+    preference_counts = np.array([len(p) for p in preference_lists], dtype=int)
+    num_variables = int(preference_counts.sum())
+    variables = np.arange(num_variables)
+    student_of = np.repeat(np.arange(len(students)), preference_counts)
+    instrument_of = np.array(
+        [instrument_index[i] for preferences in preference_lists for i in preferences],
+        dtype=int,
+    )
+    rank = variables - np.repeat(
+        np.cumsum(preference_counts) - preference_counts, preference_counts
+    )
+    # Nothing to assign, milp needs at least one variable.
+    if num_variables == 0:
+        return pd.DataFrame(band, index=students, columns=instruments)
+
+    # CONSTRAINTS:
+    # Constraint 1: 1 instrument per person.
+    constraints = [
+        LinearConstraint(
+            csr_matrix(
+                (np.ones(num_variables), (student_of, variables)),
+                shape=(len(students), num_variables),
+            ),
+            1,
+            1,
+        )
+    ]
+
+    # Constraint 2: Lower and upper limits on instrumentation.
+    if preference != "students":
+        constraints.append(
+            LinearConstraint(
+                csr_matrix(
+                    (np.ones(num_variables), (instrument_of, variables)),
+                    shape=(len(instruments), num_variables),
+                ),
+                [floor(0.75 * count) for count in idealcounts],
+                [ceil(1.5 * count) for count in idealcounts],
+            )
+        )
+
+    # OBJECTIVE:
+    # Ideal Band Composition:
+    # TODO: THIS HACK DOESN'T WORK AND GIVES BONUS FOR EXTRAS?.
+    # (count - assigned_count) is not always positive.
+    # Temporary patchwork with lower and upper constraints.
+    # The constant ideal counts are dropped, leaving -weight per assignment.
+    composition = np.full(num_variables, -composition_weight)
+
+    # Student Preferred Instruments:
+    obj = composition + rank * preference_weight
+
+    # Solve and get results.
+    start = time()
+    result = milp(
+        obj,
+        constraints=constraints,
+        integrality=np.ones(num_variables),
+        bounds=Bounds(0, 1),
+        options={"time_limit": 30},
+    )
+    end = time()
+    seconds = end - start
+    logging.info(
+        "Status:",
+        "Success"
+        if result.success
+        else "failure: proximity to ideal instrument counts impossible with current student preferences.",
+    )
+    logging.info(
+        "Seconds:" if seconds > 1 else "Milliseconds:",
+        round(seconds, 2) if seconds > 1 else int(seconds * 1000),
+    )
+    if result.x is not None:
+        # Accumulate so a repeated preference can't overwrite its assignment.
+        np.maximum.at(
+            band, (student_of, instrument_of), np.round(result.x).astype(np.int8)
+        )
+    return pd.DataFrame(band, index=students, columns=instruments)
 
 
 class BandClassLP:
@@ -26,6 +141,13 @@ class BandClassLP:
         self.preferences = list(student_preferences.values())
         self.num_instruments = len(self.instruments)
         self.num_students = len(self.students)
+        self.preference = None
+        self.band = None
+        self._rank = {
+            # Reversed so the first occurrence of a repeated instrument wins.
+            s: {i: rank for rank, i in reversed(list(enumerate(preferences)))}
+            for s, preferences in self.student_preferences.items()
+        }
         self.colors = {
             0: "darkgrey",
             1: "#FFEDA0",
@@ -56,7 +178,7 @@ class BandClassLP:
     ) -> pd.DataFrame:
         """
         Creates an optimal band through solving a linear programming problem
-        setup with Pulp.
+        with SciPy's milp.
 
         Parameters
         ----------
@@ -70,100 +192,14 @@ class BandClassLP:
         pd.DataFrame
             The band assignment solutions to the linear programming problem.
         """
-        weights = {"students": (1, 5), "balanced": (3, 3), "instrumentation": (5, 1)}
-        composition_weight, preference_weight = weights[preference]
-
-        problem = pulp.LpProblem(name=f"BandClassLp-{preference}")
-        # Setup Matrix of Parameters.
-        assignment = pulp.LpVariable.dicts(
-            "Assignment",
-            (self.students, self.instruments),
-            lowBound=0,
-            upBound=1,
-            cat=pulp.LpInteger,
-        )
-
-        # CONSTRAINTS:
-        # Constraint 1: 1 instrument per person.
-        for s in self.students:
-            problem += (
-                pulp.lpSum([assignment[s][i] for i in self.instruments]) == 1,
-                f"{s}_will_play_1_instrument.",
-            )
-
-        # Constraint 2: Lower limit on instrumentation.
-        if preference != "students":
-            for i in self.instruments:
-                problem += (
-                    pulp.lpSum([assignment[s][i] for s in self.students])
-                    >= floor(0.75 * self.instrument_idealcount[i]),
-                    f"More_than_{1.5 * self.instrument_idealcount[i]}_{i}.",
-                )
-
-        # Constraint 3: No non-selected instruments for each person.
-        for s in self.students:
-            selected_instrument = self.student_preferences[s]
-            non_selected_instruments = [
-                instrument
-                for instrument in self.instruments
-                if instrument not in selected_instrument
-            ]
-            problem += (
-                pulp.lpSum([assignment[s][i] for i in non_selected_instruments]) == 0,
-                f"{s}_instrument_selection",
-            )
-
-        # Constraint 4: Upper limit on instrumentation.
-        if preference != "students":
-            for i in self.instruments:
-                problem += (
-                    pulp.lpSum([assignment[s][i] for s in self.students])
-                    <= ceil(1.5 * self.instrument_idealcount[i]),
-                    f"Less_than_{1.5 * self.instrument_idealcount[i]}_{i}.",
-                )
-
-        # OBJECTIVE:
-        obj = 0
-
-        # Ideal Band Composition:
-        # TODO: THIS HACK DOESN'T WORK AND GIVES BONUS FOR EXTRAS?.
-        # (count - assigned_count) is not always positive.
-        # Temporary patchwork with lower and upper constraints.
-        for i, count in self.instrument_idealcount.items():
-            obj += (
-                count
-                - pulp.lpSum([assignment[s][i] for s in self.students])
-                * composition_weight
-            )
-
-        # Student Preferred Instruments:
-        for s, preferences in self.student_preferences.items():
-            obj += (
-                pulp.lpSum(
-                    [assignment[s][i] * (preferences.index(i)) for i in preferences]
-                )
-                * preference_weight
-            )
-
-        problem += obj
-
-        # Solve and get results.
-        start = time()
-        status = problem.solve()
-        end = time()
-        seconds = end - start
-        logging.info(
-            "Status:",
-            "Success"
-            if status == 1
-            else "failure: proximity to ideal instrument counts impossible with current student preferences.",
-        )
-        logging.info(
-            "Seconds:" if seconds > 1 else "Milliseconds:",
-            round(seconds, 2) if seconds > 1 else int(seconds * 1000),
-        )
         self.preference = preference
-        self.band = pd.DataFrame(assignment).applymap(pulp.value).transpose()
+        self.band = _solve(
+            tuple(self.instruments),
+            tuple(self.idealcounts),
+            tuple(self.students),
+            tuple(tuple(p) for p in self.preferences),
+            preference,
+        ).copy()
         return self.band
 
     def wrangle_band_assignments_long(
@@ -178,13 +214,16 @@ class BandClassLP:
             .reset_index()
             .rename(columns={"index": "student"})
         )
-        df["preference"] = df.apply(
-            lambda row: self.student_preferences[row.student].index(row.instrument)
-            + 1  # +1 to offset indexing
-            if row.assignment
-            else 0,
-            axis=1,
-        )
+        df["student"] = pd.Categorical(df["student"], categories=self.students)
+        df["instrument"] = pd.Categorical(df["instrument"], categories=self.instruments)
+        # Only assigned rows need a lookup, everything else is preference 0.
+        assigned = df["assignment"].to_numpy().astype(bool)
+        preference = np.zeros(len(df), dtype=np.int8)
+        preference[assigned] = [
+            self._rank[s][i] + 1  # +1 to offset indexing
+            for s, i in zip(df["student"][assigned], df["instrument"][assigned])
+        ]
+        df["preference"] = preference
         return df
 
     def display_band(
@@ -192,25 +231,29 @@ class BandClassLP:
     ) -> alt.Chart:
         """A helper function to display the assignment results of optimal band
         created get_optimal_band"""
-        if band_assignments is not None and not self.band:
-            raise ValueError(
-                "Either band_assignments or self.band is required to display results."
-            )
-        elif not band_assignments:
+        if band_assignments is None:
+            if self.band is None:
+                raise ValueError(
+                    "Either band_assignments or self.band is required to display results."
+                )
             band_assignments = self.band
         # Get Assignment Data
         df = self.wrangle_band_assignments_long(band_assignments)
+        # Only embed the columns the chart reads in the spec.
+        chart_df = df[["student", "instrument", "preference"]]
 
         # Matrix Assignment chart.
         assignment_base = (
-            alt.Chart(df)
+            alt.Chart(chart_df)
             .encode(
                 x=alt.X("instrument", sort=self.instruments, title=None),
                 y=alt.Y("student", sort=self.students, title=None),
             )
             .properties(
                 title={
-                    "text": f"Optimal Band ({self.preference.title()})",
+                    "text": f"Optimal Band ({self.preference.title()})"
+                    if self.preference
+                    else "Optimal Band",
                     "subtitle": "Band Instrument Assignments and Preferences.",
                     "fontSize": 20,
                     "anchor": "start",
@@ -232,26 +275,32 @@ class BandClassLP:
         assignment_text = (
             assignment_base.mark_text(color="grey")
             .encode(text="preference:O")
-            .transform_filter(alt.datum.preference > 0)
+            .properties(data=chart_df.loc[chart_df["preference"] > 0])
         )
         assignment_chart = assignment_rectangles + assignment_text
 
         # Instrumentation Data
         actual_counts = (
-            df.query("assignment == 1.0")[["instrument"]]
-            .value_counts()
-            .rename("actual_count")
+            df.loc[df["assignment"] == 1]
+            .groupby("instrument", observed=True)
+            .size()
+            .reindex(self.instruments, fill_value=0)
         )
-        ideal_counts = pd.Series(self.instrument_idealcount, name="ideal_count")
-        ideal_counts.index.name = "instrument"
-        instrumentation = pd.merge(
-            actual_counts, ideal_counts, on="instrument"
-        ).reset_index()
-        instrumentation["difference"] = abs(
-            instrumentation["ideal_count"] - instrumentation["actual_count"]
+        ideal_counts = pd.Series(self.instrument_idealcount).reindex(self.instruments)
+        instrumentation = pd.DataFrame(
+            {
+                "instrument": self.instruments,
+                "actual_count": actual_counts.values,
+                "ideal_count": ideal_counts.values,
+            }
         )
-        instrumentation["fill"] = instrumentation.apply(
-            lambda row: f"{row['actual_count']}/{row['ideal_count']}", axis="columns"
+        instrumentation["difference"] = (
+            instrumentation["ideal_count"] - instrumentation["actual_count"]
+        ).abs()
+        instrumentation["fill"] = (
+            instrumentation["actual_count"].astype(str)
+            + "/"
+            + instrumentation["ideal_count"].astype(str)
         )
 
         # Instrumentation Chart